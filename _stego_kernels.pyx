@@ -0,0 +1,38 @@
+# cython: language_level=3
+"""
+Optional compiled LSB kernels for stego_enhanced.py.
+
+Build in place (stego_enhanced.py falls back to NumPy when this is missing):
+    CFLAGS="-O3 -march=native" cythonize -i _stego_kernels.pyx
+"""
+cimport cython
+from libc.stdint cimport uint8_t
+import numpy as np
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef embed_lsb(uint8_t[::1] flat, const uint8_t[::1] bits):
+    """Set the least significant bit of the first len(bits) values in flat."""
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = bits.shape[0]
+    with nogil:
+        for i in range(n):
+            flat[i] = (flat[i] & 0xFE) | bits[i]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef extract_lsb(const uint8_t[::1] flat, Py_ssize_t nbytes):
+    """Pack the least significant bits of flat into nbytes bytes (MSB first)."""
+    out = np.empty(nbytes, dtype=np.uint8)
+    cdef uint8_t[::1] out_view = out
+    cdef Py_ssize_t j, k
+    cdef uint8_t b
+    with nogil:
+        for j in range(nbytes):
+            b = 0
+            for k in range(8):
+                b = (b << 1) | (flat[j * 8 + k] & 1)
+            out_view[j] = b
+    return out
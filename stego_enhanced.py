@@ -4,6 +4,83 @@ import numpy as np
 import argparse
 from getpass import getpass
 import hashlib
+import functools
+import struct
+import shutil
+import subprocess
+
+try:
+    from _stego_kernels import embed_lsb, extract_lsb
+except ImportError:  # The compiled kernels are optional - see _stego_kernels.pyx
+    embed_lsb = extract_lsb = None
+
+# Header layout: "STEG2" magic number, the message length as 4 big-endian bytes
+# and a 4-byte tag that lets decode reject a wrong password before decrypting
+MAGIC = b'STEG2'
+HEADER = struct.Struct('>5sI4s')
+TAG_PREFIX_BYTES = 16
+HEADER_BITS = HEADER.size * 8
+
+# Legacy header written by earlier versions: "STEGO" magic number and the message length, no tag
+LEGACY_MAGIC = b'STEGO'
+LEGACY_HEADER = struct.Struct('>5sI')
+LEGACY_HEADER_BITS = LEGACY_HEADER.size * 8
+
+# Image viewer used to show the encoded image on Linux/macOS, looked up once at import
+_VIEWER = None
+if os.name == 'posix':
+    _VIEWER = (shutil.which("xdg-open")  # Linux desktop default
+               or shutil.which("display")  # ImageMagick
+               or shutil.which("eog")  # Eye of GNOME
+               or shutil.which("open"))  # macOS
+
+if embed_lsb is not None:
+    _embed_bits = embed_lsb
+    _extract_bytes = extract_lsb
+else:
+    def _embed_bits(flat, bits):
+        """Set the least significant bit of the first len(bits) values in flat."""
+        n = bits.size
+        flat[:n] = (flat[:n] & 0xFE) | bits
+
+    def _extract_bytes(flat, nbytes):
+        """Pack the least significant bits of flat into nbytes bytes (MSB first)."""
+        # np.packbits is a single C pass; a weighted (N, 8) sum is ~20x slower here
+        return np.packbits(flat[:nbytes * 8] & 1)
+
+def _auth_tag(key, encrypted_message):
+    """Compute the 4-byte password check tag for an encrypted message."""
+    return hashlib.sha256(key + encrypted_message[:TAG_PREFIX_BYTES]).digest()[:4]
+
+def xor_cipher(data, key):
+    """
+    XORs data against a repeating key. Used for both encryption and decryption.
+    
+    Args:
+        data (bytes): Data to encrypt or decrypt
+        key (bytes): Encryption key, repeated to cover the whole data
+    
+    Returns:
+        bytes: The XORed data
+    """
+    data_arr = np.frombuffer(data, dtype=np.uint8)
+    key_stream = (key * (len(data) // len(key) + 1))[:len(data)]
+    key_tiled = np.frombuffer(key_stream, dtype=np.uint8)
+    return np.bitwise_xor(data_arr, key_tiled).tobytes()
+
+@functools.lru_cache(maxsize=16)
+def derive_key(password_bytes):
+    """
+    Derives the encryption key from a password. Results are cached, so batch callers
+    can call this once per password and pass the key to the *_with_key functions.
+    
+    Args:
+        password_bytes (bytes): The encoded password
+    
+    Returns:
+        bytes: The 32-byte SHA-256 key
+    """
+    return hashlib.sha256(password_bytes).digest()
 
 def encode_message(image_path, message, password, output_path="encoded_image.png"):
     """
@@ -15,6 +92,21 @@ def encode_message(image_path, message, password, output_path="encoded_image.png
         password (str): Password for encryption
         output_path (str): Path to save the encoded image
     
+    Returns:
+        bool: True if encoding was successful, False otherwise
+    """
+    return encode_message_with_key(image_path, message, derive_key(password.encode()), output_path)
+
+def encode_message_with_key(image_path, message, key, output_path="encoded_image.png"):
+    """
+    Encodes a secret message into an image using an already derived key.
+    
+    Args:
+        image_path (str): Path to the original image
+        message (str): Secret message to encode
+        key (bytes): Encryption key, as returned by derive_key
+        output_path (str): Path to save the encoded image
+    
     Returns:
         bool: True if encoding was successful, False otherwise
     """
@@ -25,72 +117,39 @@ def encode_message(image_path, message, password, output_path="encoded_image.png
             print(f"Error: Could not read image at {image_path}")
             return False
             
-        # Get image dimensions
-        height, width, channels = img.shape
+        # Work on a single flat view of the pixel data (no copy for the C-contiguous arrays cv2.imread returns)
+        img = np.ascontiguousarray(img)
+        flat = img.reshape(-1)
         
         # Calculate maximum message length that can be encoded
-        max_bytes = (height * width * 3) // 8 - 64  # Leave room for the header
+        max_bytes = flat.size // 8 - HEADER.size  # Leave room for the header
         
-        # Check if message can fit in the image
-        message_length = len(message)
-        if message_length > max_bytes:
-            print(f"Error: Message too long. Maximum length is {max_bytes} characters.")
+        # Check if the encoded message fits in the image - the bit count is known up-front,
+        # so the embed step can write exactly that many bits with no bounds checks
+        message_bytes = message.encode()
+        if len(message_bytes) > max_bytes:
+            print(f"Error: Message too long. Maximum length is {max_bytes} bytes.")
             return False
             
-        # Create a simple encryption key from the password
-        import hashlib
-        key = hashlib.sha256(password.encode()).digest()
-        
         # Encrypt the message - very basic XOR encryption
-        encrypted_message = bytearray()
-        for i, char in enumerate(message.encode()):
-            encrypted_message.append(char ^ key[i % len(key)])
+        encrypted_message = xor_cipher(message_bytes, key)
             
         # Add a fixed header with message length for easier decoding
-        # Use "STEGO" as a magic number, followed by the message length as 4 bytes
-        header = bytearray(b'STEGO') + len(encrypted_message).to_bytes(4, byteorder='big')
+        # Use "STEG2" as a magic number, followed by the message length and the password check tag
+        header = HEADER.pack(MAGIC, len(encrypted_message), _auth_tag(key, encrypted_message))
         
         # Combine header and encrypted message
         data_to_hide = header + encrypted_message
         
-        # Convert to binary
-        binary_data = ''.join(format(byte, '08b') for byte in data_to_hide)
-        
-        # Embed data in image
-        data_index = 0
-        for row in range(height):
-            for col in range(width):
-                for channel in range(channels):
-                    if data_index < len(binary_data):
-                        # Set the least significant bit
-                        img[row, col, channel] = (img[row, col, channel] & 0xFE) | int(binary_data[data_index])
-                        data_index += 1
-                    else:
-                        # We're done embedding
-                        break
-                        
-        # Save the encoded image
-        cv2.imwrite(output_path, img)
+        # Split the data into individual bits (MSB first)
+        bits = np.unpackbits(np.frombuffer(data_to_hide, dtype=np.uint8))
+
+        # Embed data in image - set the least significant bit of the first len(bits) channel values
+        _embed_bits(flat, bits)
+
+        # Save the encoded image - LSB noise compresses poorly, so use fast PNG compression
+        cv2.imwrite(output_path, img, [int(cv2.IMWRITE_PNG_COMPRESSION), 1])
         print(f"Message successfully encoded in {output_path}")
-        
-        # Try to display the image - but don't worry if it fails
-        try:
-            if os.name == 'nt':  # Windows
-                os.system(f"start {output_path}")
-            elif os.name == 'posix':  # Linux or macOS
-                # Try different methods to open the image
-                if os.system("which xdg-open > /dev/null 2>&1") == 0:
-                    os.system(f"xdg-open {output_path} > /dev/null 2>&1")
-                elif os.system("which display > /dev/null 2>&1") == 0:  # ImageMagick
-                    os.system(f"display {output_path} > /dev/null 2>&1 &")
-                elif os.system("which eog > /dev/null 2>&1") == 0:  # Eye of GNOME
-                    os.system(f"eog {output_path} > /dev/null 2>&1 &")
-                elif os.system("which open > /dev/null 2>&1") == 0:  # macOS
-                    os.system(f"open {output_path} > /dev/null 2>&1")
-        except:
-            # Not being able to open the image doesn't affect the encoding process
-            pass
-            
         return True
         
     except Exception as e:
@@ -105,6 +164,19 @@ def decode_message(image_path, password):
         image_path (str): Path to the encoded image
         password (str): Password used for encryption
     
+    Returns:
+        str: Decoded message if successful, None otherwise
+    """
+    return decode_message_with_key(image_path, derive_key(password.encode()))
+
+def decode_message_with_key(image_path, key):
+    """
+    Decodes a secret message from an image using an already derived key.
+    
+    Args:
+        image_path (str): Path to the encoded image
+        key (bytes): Decryption key, as returned by derive_key
+    
     Returns:
         str: Decoded message if successful, None otherwise
     """
@@ -115,81 +187,48 @@ def decode_message(image_path, password):
             print(f"Error: Could not read image at {image_path}")
             return None
             
-        # Get image dimensions
-        height, width, channels = img.shape
+        # Work on a single flat view of the pixel data (no copy for the C-contiguous arrays cv2.imread returns)
+        img = np.ascontiguousarray(img)
+        flat = img.reshape(-1)
         
-        # Extract bits from the image
-        extracted_bits = ""
-        for row in range(height):
-            for col in range(width):
-                for channel in range(channels):
-                    # Get the least significant bit
-                    extracted_bits += str(img[row, col, channel] & 1)
-                    
-                    # Check if we have enough bits for the header (5 bytes for 'STEGO' + 4 bytes for length)
-                    if len(extracted_bits) >= 72:  # 9 bytes * 8 bits
-                        # Convert first 40 bits (5 bytes) to check for 'STEGO' magic number
-                        header_bytes = bytearray()
-                        for i in range(0, 40, 8):
-                            byte_bits = extracted_bits[i:i+8]
-                            header_bytes.append(int(byte_bits, 2))
-                            
-                        # Check if this is a valid steganography file
-                        if header_bytes != b'STEGO':
-                            # Just continue collecting bits - might be a false start
-                            continue
-                            
-                        # Extract the message length (next 32 bits / 4 bytes)
-                        length_bits = extracted_bits[40:72]
-                        message_length_bytes = bytearray()
-                        for i in range(0, 32, 8):
-                            byte_bits = length_bits[i:i+8]
-                            message_length_bytes.append(int(byte_bits, 2))
-                            
-                        # Convert to integer
-                        message_length = int.from_bytes(message_length_bytes, byteorder='big')
-                        
-                        # Safety check for unreasonable message sizes
-                        if message_length <= 0 or message_length > (height * width * channels) // 8:
-                            # Just continue collecting bits - might be a false start
-                            continue
-                            
-                        # Calculate how many more bits we need
-                        bits_needed = message_length * 8
-                        total_bits_needed = 72 + bits_needed  # Header + message
-                        
-                        # If we don't have enough bits yet, continue extraction
-                        if len(extracted_bits) < total_bits_needed:
-                            continue
-                        
-                        # We have all the bits we need, extract the encrypted message
-                        message_bits = extracted_bits[72:total_bits_needed]
-                        
-                        # Convert bits to bytes
-                        encrypted_message = bytearray()
-                        for i in range(0, len(message_bits), 8):
-                            if i + 8 <= len(message_bits):
-                                byte_bits = message_bits[i:i+8]
-                                encrypted_message.append(int(byte_bits, 2))
-                                
-                        # Create decryption key from password
-                        import hashlib
-                        key = hashlib.sha256(password.encode()).digest()
-                        
-                        # Decrypt the message
-                        decrypted_bytes = bytearray()
-                        for i, byte in enumerate(encrypted_message):
-                            decrypted_bytes.append(byte ^ key[i % len(key)])
-                            
-                        # Convert to string
-                        try:
-                            decrypted_message = decrypted_bytes.decode('utf-8', errors='replace')
-                            return decrypted_message
-                        except UnicodeDecodeError:
-                            # If we got here with a valid STEGO header but can't decode,
-                            # it's likely an incorrect password
-                            print("Failed to decode message. Incorrect password most likely.")
-                            return None
+        # Extract just the magic number first to tell the current and legacy header layouts apart
+        magic = _extract_bytes(flat, 5).tobytes() if flat.size >= 40 else b''
+        if magic == MAGIC and flat.size >= HEADER_BITS:
+            _, message_length, tag = HEADER.unpack(_extract_bytes(flat, HEADER.size).tobytes())
+            header_bits = HEADER_BITS
+        elif magic == LEGACY_MAGIC and flat.size >= LEGACY_HEADER_BITS:
+            # Images from earlier versions carry no password check tag
+            _, message_length = LEGACY_HEADER.unpack(_extract_bytes(flat, LEGACY_HEADER.size).tobytes())
+            tag = None
+            header_bits = LEGACY_HEADER_BITS
+        else:
+            message_length = 0
+            header_bits = 0
+            
+        # Safety check for missing or unreasonable message sizes
+        if 0 < message_length <= (flat.size - header_bits) // 8:
+            # Verify the tag against the start of the message before extracting the rest
+            if tag is not None:
+                prefix = _extract_bytes(flat[header_bits:], min(message_length, TAG_PREFIX_BYTES)).tobytes()
+                if _auth_tag(key, prefix) != tag:
+                    print("Failed to decode message. Incorrect password most likely.")
+                    return None
+            
+            # Extract only the bits holding the encrypted message
+            encrypted_message = _extract_bytes(flat[header_bits:], message_length).tobytes()
+            
+            # Decrypt the message
+            decrypted_bytes = xor_cipher(encrypted_message, key)
+                
+            # Convert to string
+            try:
+                decrypted_message = decrypted_bytes.decode('utf-8', errors='replace')
+                return decrypted_message
+            except UnicodeDecodeError:
+                # If we got here with a valid header but can't decode,
+                # it's likely an incorrect password
+                print("Failed to decode message. Incorrect password most likely.")
+                return None
         
         # If we get here, we didn't find a valid message
         print("No steganography message detected in this image.")
@@ -199,17 +238,20 @@ def decode_message(image_path, password):
         print(f"Error during decoding: {e}")
         return None
 
-def binary_to_string(binary):
-    """Convert binary to string of characters."""
-    message = ""
-    for i in range(0, len(binary), 8):
-        if i + 8 <= len(binary):  # Ensure we have a full byte
-            byte = binary[i:i+8]
-            message += chr(int(byte, 2))
-    return message
+def show_image(image_path):
+    """Try to open an image in the system viewer - but don't worry if it fails."""
+    try:
+        if os.name == 'nt':  # Windows
+            os.system(f"start {image_path}")
+        elif _VIEWER:  # Linux or macOS
+            subprocess.Popen([_VIEWER, image_path],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except:
+        # Not being able to open the image doesn't affect the encoding process
+        pass
 
-def main():
-    """Main function to parse arguments and run the program."""
+def _build_parser():
+    """Build the command line argument parser."""
     parser = argparse.ArgumentParser(description="Image Steganography Tool")
     
     # Create subparsers for encode and decode commands
@@ -225,6 +267,11 @@ def main():
     decode_parser = subparsers.add_parser("decode", help="Decode a message from an image")
     decode_parser.add_argument("-i", "--image", required=True, help="Path to encoded image")
     
+    return parser
+
+def main():
+    """Main function to parse arguments and run the program."""
+    parser = _build_parser()
     args = parser.parse_args()
     
     if args.command == "encode":
@@ -233,23 +280,26 @@ def main():
         if not message:
             message = input("Enter secret message: ")
         
-        # Prompt for password securely
+        # Prompt for password securely and derive the encryption key once
         password = getpass("Enter password for encryption: ")
+        key = derive_key(password.encode())
         
         # Encode the message
-        success = encode_message(args.image, message, password, args.output)
+        success = encode_message_with_key(args.image, message, key, args.output)
         if success:
+            show_image(args.output)
             print(f"\nEncoding successful! Your message is now hidden in: {args.output}")
             print(f"Use the decode command with the same password to extract it.")
         else:
             print("\nEncoding failed. Please check the error messages above.")
         
     elif args.command == "decode":
-        # Prompt for password securely
+        # Prompt for password securely and derive the decryption key once
         password = getpass("Enter password for decryption: ")
+        key = derive_key(password.encode())
         
         # Decode the message
-        message = decode_message(args.image, password)
+        message = decode_message_with_key(args.image, key)
         if message:
             print(f"\nDecryption successful!")
             print(f"Decoded message: {message}")